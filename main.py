@@ -2,12 +2,18 @@
 # -*- coding: utf-8 -*-
 """
 Телеграм бот для отслеживания статистики веса и объёмов тела
-Все данные хранятся локально в JSON файлах для каждого пользователя
+Все данные хранятся локально в базе SQLite
 """
 
 import os
+import re
 import json
+import sqlite3
+import threading
+import asyncio
+import bisect
 import logging
+from collections import OrderedDict
 from flask import Flask
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
@@ -31,6 +37,30 @@ logger = logging.getLogger(__name__)
 # Директория для хранения данных пользователей
 DATA_DIR = "user_data"
 
+# База данных SQLite со всеми измерениями
+DB_PATH = os.path.join(DATA_DIR, "bodystat.db")
+
+# Файлы данных пользователей из прошлых версий бота (переносятся в базу при запуске)
+LEGACY_FILE_PATTERN = re.compile(r"^user_(\d+)\.json$")
+
+# Максимальное количество пользователей, чьи данные держим в памяти
+USER_CACHE_SIZE = 512
+
+# Период фоновой записи накопленных изменений в базу (в секундах)
+FLUSH_INTERVAL = 0.2
+
+# Количество накопленных записей, при котором запись в базу запускается досрочно
+FLUSH_BATCH_SIZE = 100
+
+# Максимальная пауза между повторными попытками записи после ошибок (в секундах)
+FLUSH_MAX_BACKOFF = 30
+
+# Число неудачных записей подряд, после которого новые измерения не принимаются
+FLUSH_FAILURE_LIMIT = 3
+
+# Максимальное число одновременных обращений к базе из пула потоков
+MAX_CONCURRENT_IO = 4
+
 # Импортируем настройки авторизации из конфигурационного файла
 try:
     from config import (
@@ -56,6 +86,81 @@ except ImportError:
     """
     LOG_UNAUTHORIZED_ATTEMPTS = True
 
+# Множества разрешённых пользователей для быстрой проверки доступа
+_ALLOWED_USER_IDS = frozenset(ALLOWED_USER_IDS)
+_ALLOWED_USERNAMES_LC = frozenset(u.lower() for u in ALLOWED_USERNAMES)
+
+# Допустимые диапазоны измерений в порядке ввода: вес, талия, бёдра, грудь
+MEASUREMENT_RANGES = (
+    ("Вес", 30, 300, "кг"),
+    ("Объём талии", 40, 200, "см"),
+    ("Объём бёдер", 50, 200, "см"),
+    ("Объём груди", 50, 200, "см"),
+)
+
+# Тексты сообщений бота
+ID_INFO_MESSAGE = """
+🆔 **Твоя информация:**
+
+👤 Имя: {first_name}
+🆔 ID: `{user_id}`
+📝 Username: @{username}
+🔗 Ссылка: [tg://user?id={user_id}](tg://user?id={user_id})
+
+Скопируй свой ID и отправь администратору бота для получения доступа.
+    """
+
+WELCOME_MESSAGE = """
+Привет, {first_name}! 👋
+
+Я бот для отслеживания твоей статистики веса и объёмов тела.
+
+Что я умею:
+📊 Сохранять твои измерения (вес, объёмы)
+📈 Показывать прогресс и изменения
+📅 Отображать историю за разные периоды
+💾 Все данные хранятся локально и безопасно
+
+Используй кнопки меню для навигации!
+    """
+
+HELP_MESSAGE = """
+🔧 Как пользоваться ботом:
+
+📊 Добавить измерения:
+   • Нажми кнопку "Добавить измерения"
+   • Введи данные в формате: вес талия бёдра грудь
+   • Пример: 70.5 80 95 90
+
+📈 Показать прогресс:
+   • Сравнение с предыдущими измерениями
+   • Показывает изменения по всем параметрам
+
+📅 История за период:
+   • Выбери период: неделя, месяц, 3 месяца
+   • Посмотри динамику изменений
+
+💡 Советы:
+   • Измеряйся в одно время дня
+   • Веди записи регулярно для точной статистики
+   • Все данные хранятся только у тебя
+    """
+
+MEASUREMENTS_INSTRUCTION_MESSAGE = """
+📊 Добавление новых измерений
+
+Введи свои данные в одной строке через пробел:
+**вес талия бёдра грудь**
+
+Пример: `70.5 80 95 90`
+
+Где:
+• Вес в кг (например: 70.5)
+• Талия в см (например: 80)
+• Бёдра в см (например: 95)
+• Грудь в см (например: 90)
+    """
+
 class UserStatsManager:
     """Класс для управления статистикой пользователей"""
     
@@ -63,41 +168,171 @@ class UserStatsManager:
         # Создаём директорию для данных, если её нет
         if not os.path.exists(DATA_DIR):
             os.makedirs(DATA_DIR)
-    
-    def get_user_file_path(self, user_id: int) -> str:
-        """Получить путь к файлу данных пользователя"""
-        return os.path.join(DATA_DIR, f"user_{user_id}.json")
-    
-    def load_user_data(self, user_id: int) -> Dict:
-        """Загрузить данные пользователя из файла"""
-        file_path = self.get_user_file_path(user_id)
-        if os.path.exists(file_path):
+        # Соединение используется из пула потоков, поэтому доступ к нему под блокировкой
+        self._db = sqlite3.connect(DB_PATH, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        self._init_db()
+        self._migrate_legacy_files()
+        # LRU-кэш загруженных данных: user_id -> данные пользователя
+        self._cache: "OrderedDict[int, Dict]" = OrderedDict()
+        # Ещё не записанные в базу новые записи: user_id -> записи
+        self._pending: Dict[int, List[Dict]] = {}
+        # Пользователи, чьи изменения записываются в базу прямо сейчас
+        self._flushing: set = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_wakeup: Optional[asyncio.Event] = None
+        # Число неудачных попыток записи в базу подряд
+        self._flush_failures = 0
+        # Создаётся при первом обращении, чтобы привязаться к циклу событий бота
+        self._io_semaphore: Optional[asyncio.Semaphore] = None
+    
+    def _init_db(self) -> None:
+        """Создать таблицу измерений и включить журнал WAL"""
+        with self._db_lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "user_id INTEGER NOT NULL, date TEXT NOT NULL, "
+                "weight REAL NOT NULL, waist REAL NOT NULL, hips REAL NOT NULL, chest REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS records_user_date ON records (user_id, date)")
+    
+    def _migrate_legacy_files(self) -> None:
+        """Разово перенести файлы user_<id>.json в базу"""
+        for file_name in sorted(os.listdir(DATA_DIR)):
+            match = LEGACY_FILE_PATTERN.match(file_name)
+            if not match:
+                continue
+            user_id = int(match.group(1))
+            file_path = os.path.join(DATA_DIR, file_name)
             try:
                 with open(file_path, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError) as e:
-                logger.error(f"Ошибка загрузки данных пользователя {user_id}: {e}")
-                return {"records": []}
-        return {"records": []}
-    
-    def save_user_data(self, user_id: int, data: Dict) -> bool:
-        """Сохранить данные пользователя в файл"""
-        file_path = self.get_user_file_path(user_id)
+                    records = json.load(f)["records"]
+                with self._db_lock, self._db:
+                    # Если записи уже в базе (например, прошлый перенос не успел
+                    # переименовать файл), повторно их не добавляем
+                    exists = self._db.execute(
+                        "SELECT 1 FROM records WHERE user_id = ? LIMIT 1", (user_id,)
+                    ).fetchone()
+                    if not exists:
+                        self._insert_records(user_id, records)
+                os.rename(file_path, file_path + ".migrated")
+                if exists:
+                    logger.info(f"Файл {file_path} пропущен: данные пользователя {user_id} уже в базе")
+                else:
+                    logger.info(f"Данные пользователя {user_id} перенесены из {file_path} в базу")
+            except (json.JSONDecodeError, KeyError, IOError, sqlite3.Error) as e:
+                logger.error(f"Ошибка миграции данных пользователя {user_id} из {file_path}: {e}")
+    
+    @staticmethod
+    def _make_user_data(records: List[Dict]) -> Dict:
+        """Собрать данные пользователя: записи по возрастанию даты, список их дат
+        и ссылки на последнюю и предпоследнюю записи"""
+        records.sort(key=lambda record: record["date"])
+        return {
+            "records": records,
+            "dates": [record["date"] for record in records],
+            "latest": records[-1] if records else None,
+            "previous": records[-2] if len(records) >= 2 else None,
+        }
+    
+    def _has_unflushed(self, user_id: int) -> bool:
+        """Есть ли у пользователя изменения, ещё не записанные в базу"""
+        return user_id in self._pending or user_id in self._flushing
+    
+    def _cache_put(self, user_id: int, data: Dict) -> None:
+        """Положить данные пользователя в кэш, вытеснив самые старые"""
+        self._cache[user_id] = data
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > USER_CACHE_SIZE:
+            # Данные с незаписанными изменениями не вытесняем,
+            # иначе при повторной загрузке из базы они потеряются
+            for old_user_id in self._cache:
+                if old_user_id != user_id and not self._has_unflushed(old_user_id):
+                    del self._cache[old_user_id]
+                    break
+            else:
+                break
+    
+    async def _run_io(self, func, *args):
+        """Выполнить блокирующую операцию с базой в пуле потоков, не блокируя цикл событий"""
+        if self._io_semaphore is None:
+            self._io_semaphore = asyncio.Semaphore(MAX_CONCURRENT_IO)
+        # Ограничиваем число потоков, одновременно ждущих доступа к базе
+        async with self._io_semaphore:
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+    
+    def _insert_records(self, user_id: int, records: List[Dict]) -> None:
+        """Добавить записи пользователя в базу (внутри уже открытой транзакции)"""
+        self._db.executemany(
+            "INSERT INTO records (user_id, date, weight, waist, hips, chest) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (user_id, record["date"], record["weight"], record["waist"], record["hips"], record["chest"])
+                for record in records
+            ]
+        )
+    
+    def _read_user_records(self, user_id: int) -> Dict:
+        """Прочитать записи пользователя из базы (блокирующая операция)"""
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT date, weight, waist, hips, chest FROM records WHERE user_id = ? ORDER BY date, rowid",
+                (user_id,)
+            ).fetchall()
+        return self._make_user_data([
+            {"date": date, "weight": weight, "waist": waist, "hips": hips, "chest": chest}
+            for date, weight, waist, hips, chest in rows
+        ])
+    
+    def _write_batch(self, pending: Dict[int, List[Dict]]) -> None:
+        """Записать пачку новых записей в базу одной транзакцией (блокирующая операция)"""
+        with self._db_lock, self._db:
+            for user_id, records in pending.items():
+                self._insert_records(user_id, records)
+    
+    async def _get_cached_user_data(self, user_id: int) -> Dict:
+        """Получить данные пользователя из кэша, при промахе прочитав их из базы.
+        Ошибки чтения (sqlite3.Error) пробрасываются вызывающему"""
+        if user_id in self._cache:
+            self._cache.move_to_end(user_id)
+            return self._cache[user_id]
+        
+        data = await self._run_io(self._read_user_records, user_id)
+        
+        # Пока шло чтение, данные могли загрузить и изменить параллельно
+        if user_id in self._cache:
+            return self._cache[user_id]
+        
+        self._cache_put(user_id, data)
+        return data
+    
+    async def load_user_data(self, user_id: int) -> Dict:
+        """Загрузить данные пользователя (из кэша или из базы)"""
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            return True
-        except IOError as e:
-            logger.error(f"Ошибка сохранения данных пользователя {user_id}: {e}")
+            return await self._get_cached_user_data(user_id)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка загрузки данных пользователя {user_id}: {e}")
+            # Не кэшируем, чтобы повторить чтение при следующем обращении
+            return self._make_user_data([])
+    
+    async def add_record(self, user_id: int, weight: float, waist: float, hips: float, chest: float) -> bool:
+        """Добавить новую запись измерений (попадёт в базу при ближайшей записи)"""
+        # Пока база не принимает записи, не обещаем пользователю сохранение
+        if self._flush_failures >= FLUSH_FAILURE_LIMIT:
+            logger.warning(f"Запись пользователя {user_id} отклонена: база недоступна для записи")
+            return False
+        
+        try:
+            data = await self._get_cached_user_data(user_id)
+        except sqlite3.Error as e:
+            # Без загруженной истории запись нельзя согласовать с кэшем, поэтому не принимаем её
+            logger.error(f"Ошибка загрузки данных пользователя {user_id}: {e}")
             return False
-    
-    def add_record(self, user_id: int, weight: float, waist: float, hips: float, chest: float) -> bool:
-        """Добавить новую запись измерений"""
-        data = self.load_user_data(user_id)
         
         # Создаём новую запись с текущей датой
         new_record = {
-            "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "date": datetime.now().isoformat(sep=' ', timespec='seconds'),
             "weight": weight,
             "waist": waist,
             "hips": hips,
@@ -105,45 +340,114 @@ class UserStatsManager:
         }
         
         data["records"].append(new_record)
-        return self.save_user_data(user_id, data)
+        data["dates"].append(new_record["date"])
+        data["previous"] = data["latest"]
+        data["latest"] = new_record
+        self._pending.setdefault(user_id, []).append(new_record)
+        self._wake_flush()
+        return True
     
-    def get_latest_record(self, user_id: int) -> Optional[Dict]:
+    def _wake_flush(self) -> None:
+        """Досрочно запустить запись в базу, если накопилось много изменений"""
+        # Во время повторов после ошибок не сокращаем паузу между попытками
+        if self._flush_wakeup is None or self._flush_failures:
+            return
+        pending_count = sum(len(records) for records in self._pending.values())
+        if pending_count >= FLUSH_BATCH_SIZE:
+            self._flush_wakeup.set()
+    
+    async def flush(self) -> None:
+        """Записать в базу все накопленные изменения одной транзакцией.
+        При ошибке записи возвращаются в очередь, а исключение пробрасывается"""
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        
+        batch_user_ids = set(pending)
+        self._flushing.update(batch_user_ids)
+        try:
+            await self._run_io(self._write_batch, pending)
+        except Exception:
+            self._flush_failures += 1
+            # Возвращаем записи в начало очереди, чтобы сохранить порядок
+            for user_id, records in pending.items():
+                self._pending[user_id] = records + self._pending.get(user_id, [])
+            raise
+        finally:
+            self._flushing.difference_update(batch_user_ids)
+        
+        if self._flush_failures:
+            logger.info(f"Запись в базу восстановлена после {self._flush_failures} неудачных попыток")
+            self._flush_failures = 0
+    
+    async def _flush_loop(self) -> None:
+        """Фоновая задача: периодически записывать накопленные изменения в базу"""
+        self._flush_wakeup = asyncio.Event()
+        # Цикл завершается, когда close() сбрасывает ссылку на задачу
+        while self._flush_task is not None:
+            # После ошибок увеличиваем паузу вдвое с каждой неудачной попыткой
+            delay = min(FLUSH_INTERVAL * 2 ** self._flush_failures, FLUSH_MAX_BACKOFF)
+            try:
+                await asyncio.wait_for(self._flush_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # Записи уже возвращены в очередь - повторим позже.
+                # Подробности пишем в лог только для первой ошибки подряд
+                if self._flush_failures == 1:
+                    logger.exception("Ошибка фоновой записи данных в базу, повторяем с увеличением паузы")
+    
+    def start_background_flush(self) -> None:
+        """Запустить фоновую запись изменений в текущем цикле событий"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+    
+    async def close(self) -> None:
+        """Остановить фоновую запись, сохранить оставшиеся изменения и закрыть базу"""
+        # Задачу не отменяем, чтобы не прервать запись уже забранных изменений
+        flush_task, self._flush_task = self._flush_task, None
+        if flush_task is not None:
+            self._flush_wakeup.set()
+            await flush_task
+            self._flush_wakeup = None
+        try:
+            await self.flush()
+        except Exception:
+            lost_count = sum(len(records) for records in self._pending.values())
+            logger.exception(f"Ошибка записи данных в базу при остановке бота, потеряно записей: {lost_count}")
+        finally:
+            with self._db_lock:
+                self._db.close()
+    
+    async def get_latest_record(self, user_id: int) -> Optional[Dict]:
         """Получить последнюю запись пользователя"""
-        data = self.load_user_data(user_id)
-        if data["records"]:
-            return data["records"][-1]
-        return None
+        data = await self.load_user_data(user_id)
+        return data["latest"]
     
-    def get_previous_record(self, user_id: int) -> Optional[Dict]:
+    async def get_previous_record(self, user_id: int) -> Optional[Dict]:
         """Получить предпоследнюю запись для сравнения"""
-        data = self.load_user_data(user_id)
-        if len(data["records"]) >= 2:
-            return data["records"][-2]
-        return None
+        data = await self.load_user_data(user_id)
+        return data["previous"]
     
-    def get_records_by_period(self, user_id: int, days: int) -> List[Dict]:
+    async def get_records_by_period(self, user_id: int, days: int) -> List[Dict]:
         """Получить записи за определённый период"""
-        data = self.load_user_data(user_id)
+        data = await self.load_user_data(user_id)
         if not data["records"]:
             return []
         
-        # Вычисляем дату начала периода
-        start_date = datetime.now() - timedelta(days=days)
-        filtered_records = []
-        
-        for record in data["records"]:
-            record_date = datetime.strptime(record["date"], "%Y-%m-%d %H:%M:%S")
-            if record_date >= start_date:
-                filtered_records.append(record)
-        
-        return filtered_records
+        # Даты хранятся в формате "ГГГГ-ММ-ДД чч:мм:сс", поэтому
+        # лексикографический порядок строк совпадает с хронологическим,
+        # а записи отсортированы по дате - начало периода ищем бинарным поиском
+        cutoff = (datetime.now() - timedelta(days=days)).isoformat(sep=' ', timespec='seconds')
+        start = bisect.bisect_left(data["dates"], cutoff)
+        return data["records"][start:]
 
 # Создаём экземпляр менеджера статистики
 stats_manager = UserStatsManager()
 
-# Словарь для отслеживания состояния ввода данных пользователями
-user_input_state = {}
-
 def is_user_authorized(user_id: int, username: str = None) -> bool:
     """Проверить, авторизован ли пользователь для использования бота"""
     global ADMIN_USER_ID
@@ -162,11 +466,11 @@ def is_user_authorized(user_id: int, username: str = None) -> bool:
         return user_id == ADMIN_USER_ID
     
     # Проверяем по ID пользователя
-    if user_id in ALLOWED_USER_IDS:
+    if user_id in _ALLOWED_USER_IDS:
         return True
     
     # Проверяем по username
-    if username and username.lower() in [u.lower() for u in ALLOWED_USERNAMES]:
+    if username and username.lower() in _ALLOWED_USERNAMES_LC:
         return True
     
     return False
@@ -200,44 +504,41 @@ def authorization_required(func):
 async def get_my_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Команда для получения своего Telegram ID"""
     user = update.effective_user
-    id_text = f"""
-🆔 **Твоя информация:**
+    id_text = ID_INFO_MESSAGE.format(
+        first_name=user.first_name,
+        user_id=user.id,
+        username=user.username if user.username else 'не указан'
+    )
+    await update.message.reply_text(id_text)
 
-👤 Имя: {user.first_name}
-🆔 ID: `{user.id}`
-📝 Username: @{user.username if user.username else 'не указан'}
-🔗 Ссылка: [tg://user?id={user.id}](tg://user?id={user.id})
+# Клавиатуры бота не меняются, поэтому создаём их один раз
+MAIN_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("📊 Добавить измерения")],
+    [KeyboardButton("📈 Показать прогресс"), KeyboardButton("📅 История за период")],
+    [KeyboardButton("ℹ️ Помощь")]
+], resize_keyboard=True)
 
-Скопируй свой ID и отправь администратору бота для получения доступа.
-    """
-    await update.message.reply_text(id_text)
+HISTORY_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("📅 За неделю"), KeyboardButton("📅 За месяц")],
+    [KeyboardButton("📅 За 3 месяца"), KeyboardButton("📅 За всё время")],
+    [KeyboardButton("🔙 Назад")]
+], resize_keyboard=True)
 
 def get_main_keyboard():
-    """Создать основную клавиатуру бота"""
-    keyboard = [
-        [KeyboardButton("📊 Добавить измерения")],
-        [KeyboardButton("📈 Показать прогресс"), KeyboardButton("📅 История за период")],
-        [KeyboardButton("ℹ️ Помощь")]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    """Получить основную клавиатуру бота"""
+    return MAIN_KEYBOARD
+
+def format_change(value: float, unit: str) -> str:
+    """Отформатировать изменение показателя для вывода пользователю"""
+    if value == 0:
+        return "без изменений ➡️"
+    return f"{value:+.1f} {unit} {'📈' if value > 0 else '📉'}"
 
 @authorization_required
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start"""
     user = update.effective_user
-    welcome_text = f"""
-Привет, {user.first_name}! 👋
-
-Я бот для отслеживания твоей статистики веса и объёмов тела.
-
-Что я умею:
-📊 Сохранять твои измерения (вес, объёмы)
-📈 Показывать прогресс и изменения
-📅 Отображать историю за разные периоды
-💾 Все данные хранятся локально и безопасно
-
-Используй кнопки меню для навигации!
-    """
+    welcome_text = WELCOME_MESSAGE.format(first_name=user.first_name)
     
     await update.message.reply_text(
         welcome_text,
@@ -247,52 +548,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 @authorization_required
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды помощи"""
-    help_text = """
-🔧 Как пользоваться ботом:
-
-📊 Добавить измерения:
-   • Нажми кнопку "Добавить измерения"
-   • Введи данные в формате: вес талия бёдра грудь
-   • Пример: 70.5 80 95 90
-
-📈 Показать прогресс:
-   • Сравнение с предыдущими измерениями
-   • Показывает изменения по всем параметрам
-
-📅 История за период:
-   • Выбери период: неделя, месяц, 3 месяца
-   • Посмотри динамику изменений
-
-💡 Советы:
-   • Измеряйся в одно время дня
-   • Веди записи регулярно для точной статистики
-   • Все данные хранятся только у тебя
-    """
-    
-    await update.message.reply_text(help_text)
+    await update.message.reply_text(HELP_MESSAGE)
 
 @authorization_required
 async def add_measurements(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Начать процесс добавления измерений"""
-    user_id = update.effective_user.id
-    user_input_state[user_id] = "waiting_for_measurements"
-    
-    instruction_text = """
-📊 Добавление новых измерений
-
-Введи свои данные в одной строке через пробел:
-**вес талия бёдра грудь**
-
-Пример: `70.5 80 95 90`
-
-Где:
-• Вес в кг (например: 70.5)
-• Талия в см (например: 80)
-• Бёдра в см (например: 95)
-• Грудь в см (например: 90)
-    """
+    # Состояние ввода храним в данных пользователя, которые ведёт python-telegram-bot
+    context.user_data['state'] = "waiting_for_measurements"
     
-    await update.message.reply_text(instruction_text)
+    await update.message.reply_text(MEASUREMENTS_INSTRUCTION_MESSAGE)
 
 @authorization_required
 async def show_progress(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -300,8 +564,8 @@ async def show_progress(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     user_id = update.effective_user.id
     
     # Получаем последнюю и предыдущую записи
-    latest = stats_manager.get_latest_record(user_id)
-    previous = stats_manager.get_previous_record(user_id)
+    latest = await stats_manager.get_latest_record(user_id)
+    previous = await stats_manager.get_previous_record(user_id)
     
     if not latest:
         await update.message.reply_text(
@@ -330,15 +594,6 @@ async def show_progress(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         hips_diff = latest['hips'] - previous['hips']
         chest_diff = latest['chest'] - previous['chest']
         
-        # Функция для форматирования изменений
-        def format_change(value: float, unit: str) -> str:
-            if value > 0:
-                return f"+{value:.1f} {unit} 📈"
-            elif value < 0:
-                return f"{value:.1f} {unit} 📉"
-            else:
-                return f"без изменений ➡️"
-        
         changes_text += f"⚖️ Вес: {format_change(weight_diff, 'кг')}\n"
         changes_text += f"📐 Талия: {format_change(waist_diff, 'см')}\n"
         changes_text += f"🍑 Бёдра: {format_change(hips_diff, 'см')}\n"
@@ -351,16 +606,9 @@ async def show_progress(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 @authorization_required
 async def show_history_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показать меню выбора периода для истории"""
-    keyboard = [
-        [KeyboardButton("📅 За неделю"), KeyboardButton("📅 За месяц")],
-        [KeyboardButton("📅 За 3 месяца"), KeyboardButton("📅 За всё время")],
-        [KeyboardButton("🔙 Назад")]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    
     await update.message.reply_text(
         "📅 Выбери период для просмотра истории:",
-        reply_markup=reply_markup
+        reply_markup=HISTORY_KEYBOARD
     )
 
 @authorization_required
@@ -369,11 +617,11 @@ async def show_history_period(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
     
     if days == -1:  # За всё время
-        data = stats_manager.load_user_data(user_id)
+        data = await stats_manager.load_user_data(user_id)
         records = data["records"]
         period_name = "всё время"
     else:
-        records = stats_manager.get_records_by_period(user_id, days)
+        records = await stats_manager.get_records_by_period(user_id, days)
         period_name = f"{days} дней"
     
     if not records:
@@ -383,17 +631,19 @@ async def show_history_period(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return
     
-    # Формируем текст истории
-    history_text = f"📅 **История за {period_name}:**\n\n"
+    # Формируем текст истории по частям и склеиваем один раз в конце
+    parts = [f"📅 **История за {period_name}:**\n\n"]
     
     # Если записей много, показываем только последние 10
     display_records = records[-10:] if len(records) > 10 else records
     
     for i, record in enumerate(display_records, 1):
         date_str = record['date'][:10]  # Только дата без времени
-        history_text += f"**{i}. {date_str}**\n"
-        history_text += f"⚖️ {record['weight']}кг | 📐 {record['waist']}см | "
-        history_text += f"🍑 {record['hips']}см | 📏 {record['chest']}см\n\n"
+        parts.append(
+            f"**{i}. {date_str}**\n"
+            f"⚖️ {record['weight']}кг | 📐 {record['waist']}см | "
+            f"🍑 {record['hips']}см | 📏 {record['chest']}см\n\n"
+        )
     
     # Показываем общую статистику за период
     if len(records) >= 2:
@@ -405,44 +655,56 @@ async def show_history_period(update: Update, context: ContextTypes.DEFAULT_TYPE
         hips_total_change = last_record['hips'] - first_record['hips']
         chest_total_change = last_record['chest'] - first_record['chest']
         
-        history_text += f"� **Общие иaзменения за период:**\n"
-        history_text += f"⚖️ Вес: {weight_total_change:+.1f} кг\n"
-        history_text += f"📐 Талия: {waist_total_change:+.1f} см\n"
-        history_text += f"🍑 Бёдра: {hips_total_change:+.1f} см\n"
-        history_text += f"📏 Грудь: {chest_total_change:+.1f} см\n"
+        parts.append(
+            f"� **Общие иaзменения за период:**\n"
+            f"⚖️ Вес: {weight_total_change:+.1f} кг\n"
+            f"📐 Талия: {waist_total_change:+.1f} см\n"
+            f"🍑 Бёдра: {hips_total_change:+.1f} см\n"
+            f"📏 Грудь: {chest_total_change:+.1f} см\n"
+        )
     
     if len(records) > 10:
-        history_text += f"\n📝 Показано последние 10 из {len(records)} записей"
+        parts.append(f"\n📝 Показано последние 10 из {len(records)} записей")
     
+    history_text = "".join(parts)
     await update.message.reply_text(history_text, reply_markup=get_main_keyboard())
 
+@authorization_required
+async def back_to_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Вернуться в главное меню"""
+    await update.message.reply_text(
+        "Главное меню:",
+        reply_markup=get_main_keyboard()
+    )
+
+def parse_measurements(text: str) -> Tuple[float, ...]:
+    """Разобрать строку измерений и проверить значения по MEASUREMENT_RANGES"""
+    values = text.split()
+    if len(values) != len(MEASUREMENT_RANGES):
+        raise ValueError("Неверное количество параметров")
+    
+    # Разбор и проверка за один проход: останавливаемся на первом неверном значении
+    measurements = []
+    for raw_value, (name, low, high, unit) in zip(values, MEASUREMENT_RANGES):
+        value = float(raw_value)
+        if not (low <= value <= high):
+            raise ValueError(f"{name} должен быть от {low} до {high} {unit}")
+        measurements.append(value)
+    return tuple(measurements)
+
 async def process_measurements_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработать ввод измерений пользователем"""
     user_id = update.effective_user.id
     text = update.message.text.strip()
     
     try:
-        # Парсим введённые данные
-        values = text.split()
-        if len(values) != 4:
-            raise ValueError("Неверное количество параметров")
-        
-        weight, waist, hips, chest = map(float, values)
-        
-        # Проверяем разумность значений
-        if not (30 <= weight <= 300):
-            raise ValueError("Вес должен быть от 30 до 300 кг")
-        if not (40 <= waist <= 200):
-            raise ValueError("Объём талии должен быть от 40 до 200 см")
-        if not (50 <= hips <= 200):
-            raise ValueError("Объём бёдер должен быть от 50 до 200 см")
-        if not (50 <= chest <= 200):
-            raise ValueError("Объём груди должен быть от 50 до 200 см")
+        # Парсим и проверяем введённые данные
+        weight, waist, hips, chest = parse_measurements(text)
         
         # Сохраняем данные
-        if stats_manager.add_record(user_id, weight, waist, hips, chest):
+        if await stats_manager.add_record(user_id, weight, waist, hips, chest):
             # Получаем предыдущую запись для сравнения
-            previous = stats_manager.get_previous_record(user_id)
+            previous = await stats_manager.get_previous_record(user_id)
             
             success_text = f"""
 ✅ **Измерения успешно сохранены!**
@@ -483,42 +745,35 @@ async def process_measurements_input(update: Update, context: ContextTypes.DEFAU
         await update.message.reply_text(error_text)
     
     # Сбрасываем состояние ввода
-    if user_id in user_input_state:
-        del user_input_state[user_id]
+    context.user_data.pop('state', None)
+
+# Обработчики кнопок меню: текст кнопки -> обработчик
+BUTTON_HANDLERS = {
+    "📊 Добавить измерения": add_measurements,
+    "📈 Показать прогресс": show_progress,
+    "📅 История за период": show_history_menu,
+    "📅 За неделю": lambda update, context: show_history_period(update, context, 7),
+    "📅 За месяц": lambda update, context: show_history_period(update, context, 30),
+    "📅 За 3 месяца": lambda update, context: show_history_period(update, context, 90),
+    "📅 За всё время": lambda update, context: show_history_period(update, context, -1),
+    "ℹ️ Помощь": help_command,
+    "🔙 Назад": back_to_main_menu,
+}
 
 @authorization_required
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Основной обработчик сообщений"""
-    user_id = update.effective_user.id
     text = update.message.text
     
     # Проверяем, ожидаем ли мы ввод измерений от пользователя
-    if user_id in user_input_state and user_input_state[user_id] == "waiting_for_measurements":
+    if context.user_data.get('state') == "waiting_for_measurements":
         await process_measurements_input(update, context)
         return
     
     # Обрабатываем команды с кнопок
-    if text == "📊 Добавить измерения":
-        await add_measurements(update, context)
-    elif text == "📈 Показать прогресс":
-        await show_progress(update, context)
-    elif text == "📅 История за период":
-        await show_history_menu(update, context)
-    elif text == "📅 За неделю":
-        await show_history_period(update, context, 7)
-    elif text == "📅 За месяц":
-        await show_history_period(update, context, 30)
-    elif text == "📅 За 3 месяца":
-        await show_history_period(update, context, 90)
-    elif text == "📅 За всё время":
-        await show_history_period(update, context, -1)
-    elif text == "ℹ️ Помощь":
-        await help_command(update, context)
-    elif text == "🔙 Назад":
-        await update.message.reply_text(
-            "Главное меню:",
-            reply_markup=get_main_keyboard()
-        )
+    handler = BUTTON_HANDLERS.get(text)
+    if handler:
+        await handler(update, context)
     else:
         # Неизвестная команда
         await update.message.reply_text(
@@ -526,6 +781,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             reply_markup=get_main_keyboard()
         )
 
+async def post_init(application: Application) -> None:
+    """Запуск фоновых задач после инициализации бота"""
+    stats_manager.start_background_flush()
+
+async def post_shutdown(application: Application) -> None:
+    """Сохранение данных перед остановкой бота"""
+    await stats_manager.close()
+
 def main():
     """Основная функция запуска бота"""
     # Получаем токен бота из переменной окружения
@@ -538,7 +801,13 @@ def main():
         return
     
     # Создаём приложение
-    application = Application.builder().token(bot_token).build()
+    application = (
+        Application.builder()
+        .token(bot_token)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Регистрируем обработчики команд
     application.add_handler(CommandHandler("start", start))